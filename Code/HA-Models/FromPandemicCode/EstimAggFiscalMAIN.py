@@ -7,14 +7,27 @@ import os
 from importlib import reload 
 import numpy as np
 import matplotlib.pyplot as plt
-from copy import deepcopy
-from collections import namedtuple 
+from copy import copy, deepcopy
+from collections import namedtuple, OrderedDict 
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import pickle
-import random 
+import json
+import ast
 from HARK.distribution import DiscreteDistribution, Uniform
-from HARK import multi_thread_commands, multi_thread_commands_fake
-from HARK.utilities import get_percentiles, get_lorenz_shares
+from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
 from HARK.estimation import minimize_nelder_mead
+from scipy.special import expit
+import numba
+from numba import njit, prange
+if sys.platform.startswith('linux'):
+    # The estimation forks worker processes after numba's parallel kernels have
+    # run, which only the workqueue threading layer survives (TBB hangs at exit,
+    # GNU OpenMP crashes). The kernels are only launched from the main thread,
+    # so workqueue not being thread safe does not matter
+    numba.config.THREADING_LAYER = 'workqueue'
 
 cwd             = os.getcwd()
 folders         = cwd.split(os.path.sep)
@@ -48,11 +61,233 @@ print('Parameters: R = '+str(round(Rfree_base[0],3))+', CRRA = '+str(round(CRRA,
 
 
 # -----------------------------------------------------------------------------
-def calcEstimStats(Agents):
+LorenzPctiles = np.array([0.2, 0.4, 0.6, 0.8])
+SimJobs = os.cpu_count()    # parallel jobs for simulating and for gathering/reducing agent states
+StatsPool = ThreadPoolExecutor(max_workers=SimJobs)    # for gathering/reducing agent states
+AggStateBuffers = {}    # contiguous arrays of all agents' states, reused across objective evaluations
+
+def getStateBuffer(key, size):
     '''
-    Calculate the average LW/PI-ratio and total LW / total PI for each education
-    type. Also calculate the 20th, 40th, 60th, and 80th percentile points of the
-    Lorenz curve for (liquid) wealth for all agents. 
+    Return the array of the given size kept in AggStateBuffers under key, 
+    allocating it only if there is none yet or the number of agents changed. 
+    The contents are whatever the previous user left there.
+    '''
+    out = AggStateBuffers.get(key)
+    if out is None or out.size != size:
+        out = np.empty(size)
+        AggStateBuffers[key] = out
+    return out
+
+@njit(cache=True)
+def getLorenzSharesEqualWeights(data, percentiles):
+    '''
+    Calculate the Lorenz curve at the requested percentiles of (equally weighted) 
+    data. Gives the same answer as HARK's get_lorenz_shares with equal weights, 
+    but only partially orders the data (np.partition around the few positions 
+    that are needed) instead of sorting all of it.
+    
+    Parameters
+    ----------
+    data : np.array(float)
+        The data, e.g. liquid wealth levels of all agents. 
+    percentiles : np.array(float)
+        Percentiles of the population at which to evaluate the Lorenz curve.
+
+    Returns
+    -------
+    lorenz_out : np.array(float)
+        The Lorenz curve shares at the requested percentiles.
+    '''
+    n = data.size
+    # The j-th poorest agent (counting from 0) is at population share (j+1)/n, 
+    # so we interpolate between the cumulative sums at positions lo and lo+1
+    x = np.minimum(np.maximum(percentiles*n - 1.0, 0.0), n - 1.0)
+    lo = np.floor(x).astype(np.int64)
+    hi = np.minimum(lo + 1, n - 1)
+    kth = np.unique(np.concatenate((lo, hi)))
+    
+    # After partitioning, data_part[:k+1] holds the k+1 smallest values for each k 
+    # in kth, so the cumulative sums at kth follow from the sums between them
+    data_part = np.partition(data, kth)
+    cum_data = np.empty(kth.size)
+    running = 0.0
+    start = 0
+    for j in range(kth.size):
+        running += np.sum(data_part[start:kth[j]+1])
+        start = kth[j] + 1
+        cum_data[j] = running
+    total = running + np.sum(data_part[start:])
+    
+    cum_lo = cum_data[np.searchsorted(kth, lo)]
+    cum_hi = cum_data[np.searchsorted(kth, hi)]
+    lorenz_out = (cum_lo + (x-lo)*(cum_hi-cum_lo))/total
+    return lorenz_out
+
+def getPercentilesEqualWeights(data, percentiles):
+    '''
+    Calculate the requested percentiles of (equally weighted) data. Gives the 
+    same answer as HARK's get_percentiles with equal weights, but uses 
+    np.partition to find the few order statistics that are needed instead of 
+    sorting all of the data. (np.median / np.quantile are not used because they 
+    interpolate at a different position, which would shift the targets.)
+    
+    Parameters
+    ----------
+    data : np.array(float)
+        The data, e.g. liquid wealth to permanent income ratios of all agents. 
+    percentiles : np.array(float)
+        Percentiles to calculate, between 0 and 1.
+
+    Returns
+    -------
+    pctl_out : np.array(float)
+        The requested percentiles of data.
+    '''
+    percentiles = np.asarray(percentiles)
+    n = data.size
+    # Same positions as in getLorenzSharesEqualWeights: the j-th smallest value
+    # (counting from 0) is at cumulative share (j+1)/n
+    x = np.clip(percentiles*n - 1.0, 0.0, n - 1.0)
+    lo = np.floor(x).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    
+    data_part = np.partition(data, np.unique(np.concatenate((lo, hi))))
+    pctl_out = data_part[lo] + (x-lo)*(data_part[hi]-data_part[lo])
+    return pctl_out
+
+@njit(cache=True, parallel=True)
+def calcGroupSums(values, offsets):
+    '''
+    Sum values within each group of consecutive elements, in parallel over groups.
+    
+    Parameters
+    ----------
+    values : np.array(float)
+        The values, ordered by group.
+    offsets : np.array(int)
+        Start of each group in values; the last element is values.size.
+
+    Returns
+    -------
+    sums : np.array(float)
+        The sum of values in each group.
+    '''
+    num_groups = offsets.size - 1
+    sums = np.empty(num_groups)
+    for g in prange(num_groups):
+        sums[g] = np.sum(values[offsets[g]:offsets[g+1]])
+    return sums
+
+@njit(cache=True, parallel=True)
+def calcEdStatsKernel(aLvl, aNrm, pLvl, edOffsets, with_median):
+    '''
+    Fused pass over the gathered states that computes, for each education type, 
+    everything calcEstimStats needs apart from the Lorenz points. The education
+    types are handled in parallel (prange). 
+    
+    Parameters
+    ----------
+    aLvl : np.array(float)
+        Liquid wealth levels of all agents.
+    aNrm : np.array(float)
+        Liquid wealth to permanent income ratios of all agents.
+    pLvl : np.array(float)
+        Permanent income levels of all agents.
+    edOffsets : np.array(int)
+        Start of each education type's block in the arrays above; the last 
+        element is the total number of agents.
+    with_median : boolean
+        If false, the medians (the only part that reorders the data) are skipped.
+
+    Returns
+    -------
+    aNrmMean : np.array(float)
+        Mean of aNrm for each education type.
+    aNrmMedian : np.array(float)
+        Median of aNrm for each education type (same definition as 
+        getPercentilesEqualWeights); nan if with_median is false.
+    aLvlSum : np.array(float)
+        Total liquid wealth of each education type.
+    pLvlSum : np.array(float)
+        Total permanent income of each education type.
+    '''
+    num_ed = edOffsets.size - 1
+    aNrmMean = np.empty(num_ed)
+    aNrmMedian = np.empty(num_ed)
+    aLvlSum = np.empty(num_ed)
+    pLvlSum = np.empty(num_ed)
+    for e in prange(num_ed):
+        first = edOffsets[e]
+        last = edOffsets[e+1]
+        n = last - first
+        aNrm_e = aNrm[first:last]
+        aNrmMean[e] = np.mean(aNrm_e)
+        aLvlSum[e] = np.sum(aLvl[first:last])
+        pLvlSum[e] = np.sum(pLvl[first:last])
+        if not with_median:
+            aNrmMedian[e] = np.nan
+            continue
+        
+        # Median at position 0.5*n-1 of the sorted data, as in getPercentilesEqualWeights
+        x = max(0.5*n - 1.0, 0.0)
+        lo = int(np.floor(x))
+        hi = min(lo + 1, n - 1)
+        aNrm_part = np.partition(aNrm_e, hi)
+        if hi > lo:
+            aNrm_lo = np.max(aNrm_part[:hi])
+        else:
+            aNrm_lo = aNrm_part[hi]
+        aNrmMedian[e] = aNrm_lo + (x-lo)*(aNrm_part[hi]-aNrm_lo)
+    return aNrmMean, aNrmMedian, aLvlSum, pLvlSum
+# -----------------------------------------------------------------------------
+def gatherVars(Agents, offsets, keys):
+    '''
+    Fill one contiguous array per requested variable with that simulated variable
+    of all AgentTypes, avoiding the temporary lists and extra copies of 
+    np.concatenate. Each AgentType is visited once for all the variables. The 
+    arrays are kept in AggStateBuffers and refilled in place on the next call 
+    with the same key and number of agents, so the results are only valid until then.
+    
+    Parameters
+    ----------
+    Agents : [AgentType]
+        List of AgentTypes in the economy.
+    offsets : np.array(int)
+        Start of each AgentType's block in the output; the last element is the 
+        total number of agents.
+    keys : [str]
+        Names of the variables in state_now, or of the attributes (e.g. 'MPCnow') 
+        for those that are not state variables.
+        
+    Returns
+    -------
+    outs : [np.array(float)]
+        Each variable for all agents, stacked in the order of Agents.
+    '''
+    outs = [getStateBuffer(key, offsets[-1]) for key in keys]
+    
+    def fillGroup(first):
+        # Copy the blocks of one education type (DiscFacCount AgentTypes)
+        for i in range(first, min(first+DiscFacCount, len(Agents))):
+            ThisType = Agents[i]
+            state_now = ThisType.state_now    # look up the dict once per type
+            block = slice(offsets[i], offsets[i+1])
+            for key, out in zip(keys, outs):
+                var = state_now.get(key)
+                if var is None:
+                    var = getattr(ThisType, key)
+                out[block] = var
+    
+    # The blocks do not overlap and NumPy releases the GIL while copying
+    list(StatsPool.map(fillGroup, range(0, len(Agents), DiscFacCount)))
+    return outs
+# -----------------------------------------------------------------------------
+def gatherAgentStates(Agents, MPC=False):
+    '''
+    Gather the simulated states of all AgentTypes into flat arrays, so that the
+    statistics functions below do not each have to walk the list of AgentTypes. 
+    The arrays are the shared buffers in AggStateBuffers (see gatherVars), so 
+    they are overwritten by the next call.
     Assumption: Agents is organized by EducType and there are DiscFacCount
     AgentTypes of each EducType. 
     
@@ -60,90 +295,126 @@ def calcEstimStats(Agents):
     ----------
     Agents : [AgentType]
         List of AgentTypes in the economy.
+    MPC : boolean, optional
+        If true, the MPCs of the agents are gathered as well. The default is False.
         
     Returns
     -------
-    Stats : namedtuple("avgLWPI", "LWoPI", "LorenzPts")
-    avgLWPI : [float] 
+    States : namedtuple("aLvl", "aNrm", "pLvl", "MPCnow", "Offsets", "EdOffsets", "EdSlices")
+    aLvl : np.array(float)
+        Liquid wealth levels of all agents.
+    aNrm : np.array(float)
+        Liquid wealth to permanent income ratios of all agents.
+    pLvl : np.array(float)
+        Permanent income levels of all agents.
+    MPCnow : np.array(float) or None
+        MPCs of all agents (None unless MPC is True).
+    Offsets : np.array(int)
+        Start of each AgentType's block in the arrays above; the last element 
+        is the total number of agents.
+    EdOffsets : np.array(int)
+        Start of each education type's block in the arrays above; the last 
+        element is the total number of agents.
+    EdSlices : [slice]
+        The slice of the arrays above that belongs to each education type. 
+    '''
+    AgentCounts = np.fromiter((ThisType.AgentCount for ThisType in Agents), dtype=np.int64, count=len(Agents))
+    offsets = np.concatenate(([0], np.cumsum(AgentCounts)))
+    if MPC:
+        aLvl, aNrm, pLvl, MPCnow = gatherVars(Agents, offsets, ["aLvl", "aNrm", "pLvl", "MPCnow"])
+    else:
+        aLvl, aNrm, pLvl = gatherVars(Agents, offsets, ["aLvl", "aNrm", "pLvl"])
+        MPCnow = None
+
+    EdOffsets = offsets[::DiscFacCount]
+    EdSlices = [slice(EdOffsets[e], EdOffsets[e+1]) for e in range(EdOffsets.size-1)]
+
+    States = namedtuple("States", ["aLvl", "aNrm", "pLvl", "MPCnow", "Offsets", "EdOffsets", "EdSlices"])
+
+    return States(aLvl, aNrm, pLvl, MPCnow, offsets, EdOffsets, EdSlices)
+# -----------------------------------------------------------------------------
+def calcEstimStats(States, mode='all'):
+    '''
+    Calculate the average LW/PI-ratio and total LW / total PI for each education
+    type. Also calculate the 20th, 40th, 60th, and 80th percentile points of the
+    Lorenz curve for (liquid) wealth for all agents. 
+    
+    Parameters
+    ----------
+    States : namedtuple
+        Gathered states of all AgentTypes in the economy, see gatherAgentStates.
+    mode : str, optional
+        Which statistics are needed: 'lorenz_median' for medianLWPI and LorenzPts
+        (target_option 1), 'avg' for avgLWPI (target_option 2), or 'all'. The 
+        statistics that are not needed are None; avgLWPI and LWoPI come out of 
+        the same pass as the medians and are always calculated. The default is 'all'.
+        
+    Returns
+    -------
+    Stats : namedtuple("avgLWPI", "LWoPI", "medianLWPI", "LorenzPts")
+    avgLWPI : np.array(float) 
         The weighted average of LW/PI-ratio for each education type.
-    LWoPI : [float]
+    LWoPI : np.array(float)
         Total liquid wealth / total permanent income for each education type. 
+    medianLWPI : np.array(float)
+        The median LW/PI-ratio for each education type (one row per type).
     LorenzPts : [float]
         The 20th, 40th, 60th, and 80th percentile points of the Lorenz curve for 
         (liquid) wealth.
     '''
 
-    aLvlAll = np.concatenate([ThisType.state_now["aLvl"] for ThisType in Agents])
-    numAgents = 0
-    for ThisType in Agents: 
-        numAgents += ThisType.AgentCount
-    weights = np.ones(numAgents) / numAgents      # just using equal weights for now
-
-    # Lorenz points:
-    LorenzPts = 100*get_lorenz_shares(aLvlAll, weights=weights, percentiles = [0.2, 0.4, 0.6, 0.8] )
-
-    avgLWPI = [0]*num_types
-    LWoPI = [0]*num_types 
-    medianLWPI = [0]*num_types 
-    for e in range(num_types):
-        aNrmAll_byEd = []
-        aNrmAll_byEd = np.concatenate([(1-ThisType.Splurge)*ThisType.state_now['aNrm'] for ThisType in \
-                          Agents[e*DiscFacCount:(e+1)*DiscFacCount]])
-        weights = np.ones(len(aNrmAll_byEd))/len(aNrmAll_byEd)
-        avgLWPI[e] = np.dot(aNrmAll_byEd, weights) * 100
-        
-        aLvlAll_byEd = []
-        aLvlAll_byEd = np.concatenate([ThisType.state_now["aLvl"] for ThisType in \
-                          Agents[e*DiscFacCount:(e+1)*DiscFacCount]])
-        pLvlAll_byEd = []
-        pLvlAll_byEd = np.concatenate([ThisType.state_now['pLvl'] for ThisType in \
-                          Agents[e*DiscFacCount:(e+1)*DiscFacCount]])
-        LWoPI[e] = np.dot(aLvlAll_byEd, weights) / np.dot(pLvlAll_byEd, weights) * 100
-
-        medianLWPI[e] = 100*get_percentiles(aNrmAll_byEd,weights=weights,percentiles=[0.5])
+    with_median = (mode != 'avg')
+    
+    # Lorenz points (just using equal weights for now):
+    if mode != 'avg':
+        LorenzPts = 100*getLorenzSharesEqualWeights(States.aLvl, LorenzPctiles)
+    else:
+        LorenzPts = None
+
+    aNrmMean, aNrmMedian, aLvlSum, pLvlSum = calcEdStatsKernel(States.aLvl, States.aNrm, 
+                                                               States.pLvl, States.EdOffsets, with_median)
+    # Liquid wealth excludes the splurge share; (1-Splurge) is a common positive 
+    # factor, so it is applied to the mean and median rather than to every agent
+    avgLWPI = 100 * (1-Splurge) * aNrmMean
+    LWoPI = 100 * aLvlSum / pLvlSum
+    # One column, so that medianLWPI[e] is a 1-element array as from get_percentiles
+    if with_median:
+        medianLWPI = 100 * (1-Splurge) * aNrmMedian[:, np.newaxis]
+    else:
+        medianLWPI = None
 
     Stats = namedtuple("Stats", ["avgLWPI", "LWoPI", "medianLWPI", "LorenzPts"])
 
     return Stats(avgLWPI, LWoPI, medianLWPI, LorenzPts) 
 # -----------------------------------------------------------------------------
-def calcWealthShareByEd(Agents):
+def calcWealthShareByEd(States):
     '''
     Calculate the share of total wealth held by each education type. 
-    Assumption: Agents is organized by EducType and there are DiscFacCount
-    AgentTypes of each EducType. 
     
     Parameters
     ----------
-    Agents : [AgentType]
-        List of all AgentTypes in the economy. They are assumed to differ in 
-        their EducType attribute.
+    States : namedtuple
+        Gathered states of all AgentTypes in the economy, see gatherAgentStates.
 
     Returns
     -------
     WealthShares : np.array(float)
         The share of total liquid wealth held by each education type. 
     '''
-    aLvlAll = np.concatenate([ThisType.state_now["aLvl"] for ThisType in Agents])
-    totLiqWealth = np.sum(aLvlAll)
-    
-    WealthShares = [0]*num_types
-    for e in range(num_types):
-        aLvlAll_byEd = []
-        aLvlAll_byEd = np.concatenate([ThisType.state_now["aLvl"] for ThisType in \
-                                       Agents[e*DiscFacCount:(e+1)*DiscFacCount]])
-        WealthShares[e] = np.sum(aLvlAll_byEd)/totLiqWealth * 100
+    totLiqWealth = np.sum(States.aLvl)
+    WealthShares = calcGroupSums(States.aLvl, States.EdOffsets)/totLiqWealth * 100
     
-    return np.array(WealthShares)
+    return WealthShares
 # -----------------------------------------------------------------------------
-def calcLorenzPts(Agents):
+def calcLorenzPts(aLvl):
     '''
     Calculate the 20th, 40th, 60th, and 80th percentile points of the
-    Lorenz curve for (liquid) wealth for the given set of Agents. 
+    Lorenz curve for (liquid) wealth for the given set of agents. 
 
     Parameters
     ----------
-    Agents : [AgentType]
-        List of AgentTypes.
+    aLvl : np.array(float)
+        Liquid wealth levels of the agents, e.g. States.aLvl[States.EdSlices[e]].
 
     Returns
     -------
@@ -151,28 +422,44 @@ def calcLorenzPts(Agents):
         The 20th, 40th, 60th, and 80th percentile points of the Lorenz curve for 
         (liquid) wealth.
     '''
-    aLvlAll = np.concatenate([ThisType.state_now["aLvl"] for ThisType in Agents])
-    numAgents = 0
-    for ThisType in Agents: 
-        numAgents += ThisType.AgentCount
-    weights = np.ones(numAgents) / numAgents      # just using equal weights for now
-    
-    # Lorenz points:
-    LorenzPts = 100*get_lorenz_shares(aLvlAll, weights=weights, percentiles = [0.2, 0.4, 0.6, 0.8] )
+    # Lorenz points (just using equal weights for now):
+    LorenzPts = 100*getLorenzSharesEqualWeights(aLvl, LorenzPctiles)
 
     return LorenzPts
 # -----------------------------------------------------------------------------
-def calcMPCbyEd(Agents):
+def calcAnnualMPC(MPC_Q):
+    '''
+    Calculate annual MPCs from quarterly ones, with splurge and MPC in the first 
+    quarter and only MPC in the other three, i.e. A = 1 - (1-Splurge)*(1-MPC_Q)**4. 
+    The result is written into the reused buffer AggStateBuffers['MPC_all_A'], 
+    so it is only valid until the next call.
+
+    Parameters
+    ----------
+    MPC_Q : np.array(float)
+        Quarterly MPCs of the agents.
+
+    Returns
+    -------
+    MPC_A : np.array(float)
+        Annual MPCs of the agents, taking splurge into account.
+    '''
+    MPC_A = getStateBuffer('MPC_all_A', MPC_Q.size)
+    np.subtract(1.0, MPC_Q, out=MPC_A)
+    np.power(MPC_A, 4, out=MPC_A)
+    np.multiply(MPC_A, 1.0-Splurge, out=MPC_A)
+    np.subtract(1.0, MPC_A, out=MPC_A)
+    return MPC_A
+# -----------------------------------------------------------------------------
+def calcMPCbyEd(States):
     '''
     Calculate the average MPC for each education type. 
-    Assumption: Agents is organized by EducType and there are DiscFacCount
-    AgentTypes of each EducType. 
     
     Parameters
     ----------
-    Agents : [AgentType]
-        List of all AgentTypes in the economy. They are assumed to differ in 
-        their EducType attribute.
+    States : namedtuple
+        Gathered states of all AgentTypes in the economy, including their MPCs, 
+        see gatherAgentStates.
 
     Returns
     -------
@@ -183,44 +470,32 @@ def calcMPCbyEd(Agents):
         The average MPC for each education type - Annualized, taking splurge into account. 
         (Only splurge in the first quarter.)
     '''
-    MPCsQ = [0]*(num_types+1)   # MPC for each eduation type + for whole population
-    MPCsA = [0]*(num_types+1)   # Annual MPCs with splurge (each ed. type + population)
-    for e in range(num_types):
-        MPC_byEd_Q = []
-        MPC_byEd_Q = np.concatenate([ThisType.MPCnow for ThisType in \
-                                       Agents[e*DiscFacCount:(e+1)*DiscFacCount]])
-
-        MPC_byEd_A = Splurge + (1-Splurge)*MPC_byEd_Q
-        for qq in range(3):
-            MPC_byEd_A += (1-MPC_byEd_A)*MPC_byEd_Q
-        
-        MPCsQ[e] = np.mean(MPC_byEd_Q)
-        MPCsA[e] = np.mean(MPC_byEd_A)
-        
-    MPC_all_Q = np.concatenate([ThisType.MPCnow for ThisType in Agents])
-    MPC_all_A = Splurge + (1-Splurge)*MPC_all_Q
-    for qq in range(3):
-        MPC_all_A += (1-MPC_all_A)*MPC_all_Q
+    MPC_all_Q = States.MPCnow
+    MPC_all_A = calcAnnualMPC(MPC_all_Q)
     
-    MPCsQ[e+1] = np.mean(MPC_all_Q)
-    MPCsA[e+1] = np.mean(MPC_all_A)
+    # MPC for each eduation type + for whole population
+    EdCounts = np.diff(States.EdOffsets)
+    MPCsQ = list(calcGroupSums(MPC_all_Q, States.EdOffsets)/EdCounts)
+    MPCsA = list(calcGroupSums(MPC_all_A, States.EdOffsets)/EdCounts)
+    MPCsQ.append(np.mean(MPC_all_Q))
+    MPCsA.append(np.mean(MPC_all_A))
 
     MPCs = namedtuple("MPCs", ["MPCsQ", "MPCsA"])
  
     return MPCs(MPCsQ,MPCsA)
  
 # -----------------------------------------------------------------------------
-def calcMPCbyWealth(Agents):
+def calcMPCbyWealth(Agents, States):
     '''
     Calculate the average MPC for each wealth quartile. 
-    Assumption: Agents is organized by EducType and there are DiscFacCount
-    AgentTypes of each EducType. 
     
     Parameters
     ----------
     Agents : [AgentType]
-        List of all AgentTypes in the economy. They are assumed to differ in 
-        their EducType attribute.
+        List of all AgentTypes in the economy. Each gets its WealthQ attribute set.
+    States : namedtuple
+        Gathered states of the same AgentTypes, including their MPCs, see 
+        gatherAgentStates.
 
     Returns
     -------
@@ -231,38 +506,65 @@ def calcMPCbyWealth(Agents):
         The average MPC for each wealth quartile - Annualized, taking splurge into account. 
         (Only splurge in the first quarter.)
     '''
-    WealthNow = np.concatenate([ThisType.state_now["aLvl"] for ThisType in Agents])
+    WealthNow = States.aLvl
     
     # Get wealth quartile cutoffs and distribute them to each consumer type
-    quartile_cuts = get_percentiles(WealthNow,percentiles=[0.25,0.50,0.75])
-    WealthQsAll = np.array([])
-    for ThisType in Agents:
-        WealthQ = np.zeros(ThisType.AgentCount,dtype=int)
-        for n in range(3):
-            WealthQ[ThisType.state_now["aLvl"] > quartile_cuts[n]] += 1
-        ThisType(WealthQ = WealthQ)
-        WealthQsAll = np.concatenate([WealthQsAll, WealthQ])
-    
-    MPC_agents_Q = np.concatenate([ThisType.MPCnow for ThisType in Agents])
-    # Annual MPC: first Q includes Splurge, other three Qs do not
-    MPC_agents_A = Splurge+(1-Splurge)*MPC_agents_Q
-    for qq in range(3):
-        MPC_agents_A += (1-MPC_agents_A)*MPC_agents_Q
-
-    MPCsQ = [0]*(4+1)       # MPC for each quartile + for whole population
-    MPCsA = [0]*(4+1)       # Annual MPCs with splurge (each quartile + population)
-    # Mean MPCs for each of the 4 quartiles of wealth + all agents         
-    for qq in range(4):
-        MPCsQ[qq] = np.mean(MPC_agents_Q[WealthQsAll==qq])
-        MPCsA[qq] = np.mean(MPC_agents_A[WealthQsAll==qq])
-    MPCsQ[4] = np.mean(MPC_agents_Q)
-    MPCsA[4] = np.mean(MPC_agents_A)
+    quartile_cuts = getPercentilesEqualWeights(WealthNow, [0.25, 0.50, 0.75])
+    # (side='left' counts the cutoffs strictly below each agent's wealth)
+    WealthQsAll = np.searchsorted(quartile_cuts, WealthNow, side='left')
+    for i, ThisType in enumerate(Agents):
+        ThisType(WealthQ = WealthQsAll[States.Offsets[i]:States.Offsets[i+1]])
+    
+    MPC_agents_Q = States.MPCnow
+    MPC_agents_A = calcAnnualMPC(MPC_agents_Q)
+
+    # Mean MPCs for each of the 4 quartiles of wealth (group sums / group counts)
+    # + all agents         
+    countsQ = np.bincount(WealthQsAll, minlength=4)
+    MPCsQ = list(np.bincount(WealthQsAll, weights=MPC_agents_Q, minlength=4)/countsQ)
+    MPCsA = list(np.bincount(WealthQsAll, weights=MPC_agents_A, minlength=4)/countsQ)
+    MPCsQ.append(np.mean(MPC_agents_Q))     # MPC for each quartile + for whole population
+    MPCsA.append(np.mean(MPC_agents_A))     # Annual MPCs with splurge (each quartile + population)
     
     MPCs = namedtuple("MPCs", ["MPCsQ", "MPCsA"])
  
     return MPCs(MPCsQ,MPCsA)    
  
 # -----------------------------------------------------------------------------
+@lru_cache(maxsize=4096)
+def _discretizeDiscFacs(beta_r, nabla_r):
+    '''
+    Cached equiprobable discretization of Uniform(beta_r-nabla_r, beta_r+nabla_r). 
+    Call through discretizeDiscFacs, which rounds the arguments to build the key.
+    The atoms are the midpoints of DiscFacCount equally wide intervals, which is 
+    what Uniform.discretize returns, computed here without building the HARK 
+    distribution objects.
+    '''
+    DiscFacs = (beta_r-nabla_r) + (2*nabla_r)*(np.arange(DiscFacCount)+0.5)/DiscFacCount
+    DiscFacs.flags.writeable = False     # shared between calls, so must not be modified
+    return DiscFacs
+
+def discretizeDiscFacs(beta, nabla):
+    '''
+    Return the DiscFacCount atoms of the discrete approximation to a uniform 
+    distribution of discount factors. Nelder-Mead evaluates many nearby and 
+    repeated (beta, nabla) points, so results are cached with the arguments 
+    rounded to 1e-8.
+    
+    Parameters
+    ----------
+    beta : float
+        Central value of the discount factor distribution.
+    nabla : float
+        Half the width of the discount factor distribution.
+    
+    Returns
+    -------
+    DiscFacs : np.array(float)
+        The atoms of the discretized distribution (read-only).
+    '''
+    return _discretizeDiscFacs(round(float(beta), 8), round(float(nabla), 8))
+# -----------------------------------------------------------------------------
 def checkDiscFacDistribution(beta, nabla, GICfactor, educ_type, print_mode=False, print_file=False, filename='DefaultResultsFile.txt'):
     '''
     Calculate max and min discount factors in discrete approximation to uniform 
@@ -296,33 +598,90 @@ def checkDiscFacDistribution(beta, nabla, GICfactor, educ_type, print_mode=False
     GICsatisfied : boolean
         True if betaMax satisfies the GIC for this education group. 
     '''
-    DiscFacDstnBase = Uniform(beta-nabla, beta+nabla).discretize(DiscFacCount)
-    betaMin = DiscFacDstnBase.atoms[0][0]
-    betaMax = DiscFacDstnBase.atoms[0][DiscFacCount-1]
-    GICsatisfied = (betaMax < GICmaxBetas[educ_type]*GICfactor)
+    gicCap = GICmaxBetas[educ_type]*GICfactor    # imposed upper bound on beta
+    DiscFacDstnBase = discretizeDiscFacs(beta, nabla)
+    betaMin = DiscFacDstnBase[0]
+    betaMax = DiscFacDstnBase[DiscFacCount-1]
+    GICsatisfied = (betaMax < gicCap)
 
-    DiscFacDstnActual = DiscFacDstnBase.atoms[0].copy()    
-    for thedf in range(DiscFacCount):
-        if DiscFacDstnActual[thedf] > GICmaxBetas[educ_type]*GICfactor: 
-            DiscFacDstnActual[thedf] = GICmaxBetas[educ_type]*GICfactor
-        elif DiscFacDstnActual[thedf] < minBeta:
-            DiscFacDstnActual[thedf] = minBeta
+    DiscFacDstnActual = np.clip(DiscFacDstnBase, minBeta, gicCap)
 
     if print_mode:
-        print('Base approximation to beta distribution:\n'+str(np.round(DiscFacDstnBase.atoms[0],4))+'\n')
+        print('Base approximation to beta distribution:\n'+str(np.round(DiscFacDstnBase,4))+'\n')
         print('Actual approximation to beta distribution:\n'+str(np.round(DiscFacDstnActual,4))+'\n')
         print('GIC satisfied = '+str(GICsatisfied)+'\tGICmaxBeta = '+str(round(GICmaxBetas[educ_type],4))+'\n')
-        print('Imposed GIC consistent maximum beta = ' + str(round(GICmaxBetas[educ_type]*GICfactor,5))+'\n\n')
+        print('Imposed GIC consistent maximum beta = ' + str(round(gicCap,5))+'\n\n')
         
     if print_file:
         with open(filename, 'a') as resFile: 
-            resFile.write('\tBase approximation to beta distribution:\n\t'+str(np.round(DiscFacDstnBase.atoms[0],4))+'\n')
+            resFile.write('\tBase approximation to beta distribution:\n\t'+str(np.round(DiscFacDstnBase,4))+'\n')
             resFile.write('\tActual approximation to beta distribution:\n\t'+str(np.round(DiscFacDstnActual,4))+'\n')
             resFile.write('\tGIC satisfied = '+str(GICsatisfied)+'\tGICmaxBeta = '+str(round(GICmaxBetas[educ_type],4))+'\n')
-            resFile.write('\tImposed GIC-consistent maximum beta = ' + str(round(GICmaxBetas[educ_type]*GICfactor,5))+'\n\n')
+            resFile.write('\tImposed GIC-consistent maximum beta = ' + str(round(gicCap,5))+'\n\n')
     
     dfCheck = namedtuple("dfCheck", ["betaMin", "betaMax", "GICsatisfied"])
     return dfCheck(betaMin, betaMax, GICsatisfied)    
+# -----------------------------------------------------------------------------
+# Attributes that simulate() and save_state() change; only these are sent back 
+# from the worker processes. The income distributions' RNGs also advance in the 
+# workers, but initialize_sim() resets them before the next simulation anyway.
+SimStateAttrs = ('state_now', 'state_prev', 'shocks', 'controls', 'history', 'RNG', 
+                 't_age', 't_cycle', 't_sim', 'who_dies', 'update', 'MPCnow', 'MPCNow',
+                 'MrkvNowPcvd', 'MrkvNow_temp', 'MacroMrkvNow', 'MicroMrkvNow', 'EconomyMrkvNow',
+                 'aNrm_base', 'pLvl_base', 'Mrkv_base', 'cycle_base', 'age_base', 
+                 't_sim_base', 'PlvlAgg_base')
+
+# Attributes set by get_economy_data that only the solver uses; ADFunc is a lambda 
+# bound to the economy, so they are not sent to the worker processes
+SimEconomyAttrs = ('ADFunc', 'CFunc')
+
+def simulateType(ThisType):
+    '''
+    Worker for simulateTypes: simulate one AgentType and save its state. 
+    
+    Parameters
+    ----------
+    ThisType : AgentType
+        A solved and initialized AgentType (a copy, in a worker process).
+
+    Returns
+    -------
+    SimAttrs : dict
+        The attributes in SimStateAttrs of ThisType after simulating. 
+    '''
+    ThisType.simulate()
+    ThisType.save_state()
+    return {key: ThisType.__dict__[key] for key in SimStateAttrs if key in ThisType.__dict__}
+
+def simulateTypes(Agents):
+    '''
+    Simulate the (independent) AgentTypes in parallel worker processes and copy 
+    the simulated attributes back onto the AgentTypes in Agents. Unlike 
+    multi_thread_commands, the AgentType objects themselves stay in place and 
+    the solutions are not pickled back from the workers. 
+    
+    Parameters
+    ----------
+    Agents : [AgentType]
+        List of solved and initialized AgentTypes.
+
+    Returns
+    -------
+    None
+    '''
+    SimTypes = []
+    for ThisType in Agents:
+        SimType = copy(ThisType)
+        for key in SimEconomyAttrs:
+            SimType.__dict__.pop(key, None)
+        SimTypes.append(SimType)
+    
+    num_jobs = min(len(Agents), SimJobs)
+    # joblib's default (loky) backend keeps its worker processes between calls 
+    # and does not re-run this script in them
+    SimAttrsList = Parallel(n_jobs=num_jobs)(delayed(simulateType)(SimType) for SimType in SimTypes)
+    for ThisType, SimAttrs in zip(Agents, SimAttrsList):
+        ThisType.__dict__.update(SimAttrs)
 
 # =============================================================================
 #%% Initialize economy
@@ -344,21 +703,31 @@ BaseTypeList = [InfHorizonTypeAgg_d, InfHorizonTypeAgg_h, InfHorizonTypeAgg_c ]
       
 # Fill in the Markov income distribution for each base type
 # NOTE: THIS ASSUMES NO LIFECYCLE
-IncomeDstn_unemp = DiscreteDistribution(np.array([1.0]), [np.array([1.0]), np.array([InfHorizonTypeAgg_d.IncUnemp])])
-IncomeDstn_unemp_nobenefits = DiscreteDistribution(np.array([1.0]), [np.array([1.0]), np.array([InfHorizonTypeAgg_d.IncUnempNoBenefits])])
+# (both distributions share the same arrays for the probability and permanent shock)
+OneArray = np.ones(1)
+IncomeDstn_unemp = DiscreteDistribution(OneArray, [OneArray, np.array([InfHorizonTypeAgg_d.IncUnemp])])
+IncomeDstn_unemp_nobenefits = DiscreteDistribution(OneArray, [OneArray, np.array([InfHorizonTypeAgg_d.IncUnempNoBenefits])])
     
 for ThisType in BaseTypeList:
-    EmployedIncomeDstn = deepcopy(ThisType.IncShkDstn[0])
     ThisType.IncShkDstn = [[ThisType.IncShkDstn[0]] + [IncomeDstn_unemp]*UBspell_normal + [IncomeDstn_unemp_nobenefits]]
     ThisType.IncomeDstn_base = ThisType.IncShkDstn
     
+# Number of agents in each AgentType of each education level. The discount factor 
+# distributions are equiprobable (pmv = 1/DiscFacCount), so this is the same for 
+# all types of an education level and does not change when beta and nabla do; 
+# int() truncates, i.e. floors the positive count
+EdTypeAgentCounts = [int(AgentCountTotal*data_EducShares[e]*(1.0/DiscFacCount)) for e in range(num_types)]
+
 # Make the overall list of types
 TypeList = []
 n = 0
 for e in range(num_types):
     for b in range(DiscFacCount):
         DiscFac = DiscFacDstns[e].atoms[0][b]
-        AgentCount = int(np.floor(AgentCountTotal*data_EducShares[e]*DiscFacDstns[e].pmv[b]))
+        AgentCount = EdTypeAgentCounts[e]
+        # Each type gets its own copy of the income distributions: drawing shocks 
+        # advances a distribution's own RNG, so sharing them would couple the 
+        # types' shock streams
         ThisType = deepcopy(BaseTypeList[e])
         ThisType.AgentCount = AgentCount
         ThisType.DiscFac = DiscFac
@@ -387,6 +756,113 @@ output_keys = ['NPV_AggIncome', 'NPV_AggCons', 'AggIncome', 'AggCons']
 
 #%% Objective functions
 # -----------------------------------------------------------------------------
+SimStatsCache = OrderedDict()    # (mode,)+simStatsKey(Agents) -> (Stats, EdLorenzPts), least recently used first
+SimStatsCacheSize = 256
+
+def simStatsKey(Agents):
+    '''
+    Key for SimStatsCache: everything that differs between the types across 
+    objective evaluations. Given these, solving and simulating the economy is 
+    deterministic, so Nelder-Mead steps that map to the same (e.g. GIC-clipped) 
+    discount factors can reuse the statistics.
+    '''
+    return tuple((ThisType.EducType, ThisType.AgentCount, round(float(ThisType.DiscFac), 10), ThisType.seed) \
+                 for ThisType in Agents)
+
+def solveAndSimulate(Agents, MPC=False):
+    '''
+    Solve the economy with the given AgentTypes, simulate them to get a new 
+    steady state and gather the resulting states. In the estimation there is no
+    aggregate demand feedback (ADelasticity is 0 and there is no base_AggCons), 
+    so the AgentTypes are independent of each other and Agents can be a subset 
+    of the economy's agents, e.g. the types of one education level; the other
+    types are then neither solved nor simulated.
+    
+    Parameters
+    ----------
+    Agents : [AgentType]
+        AgentTypes in the economy, with updated discount factors. Either 
+        AggDemandEconomy.agents (and base_dict['Agents']) itself, as the types 
+        are updated in place, or the types of whole education levels in it.
+    MPC : boolean, optional
+        If true, the MPCs of the agents are gathered as well. The default is False.
+
+    Returns
+    -------
+    States : namedtuple
+        Gathered states of all AgentTypes in the economy, see gatherAgentStates.
+    '''
+    AllAgents = AggDemandEconomy.agents
+    AggDemandEconomy.agents = Agents
+    try:
+        AggDemandEconomy.solve()
+    
+        # AggDemandEconomy.reset() already calls initialize_sim() for every agent; 
+        # a second call would just reseed and redraw the same initial states
+        AggDemandEconomy.reset()
+        for agent in AggDemandEconomy.agents:
+            agent.AggDemandFac = 1.0
+            agent.RfreeNow = 1.0
+            agent.CaggNow = 1.0
+    
+        AggDemandEconomy.make_history()   
+        AggDemandEconomy.save_state()   
+    finally:
+        AggDemandEconomy.agents = AllAgents
+
+    # Simulate each type to get a new steady state solution 
+    # solve: done in AggDemandEconomy.solve(), initializeSim: done in AggDemandEconomy.reset() 
+    # The types are independent, so simulate() and save_state() run in parallel
+    simulateTypes(Agents)
+    
+    return gatherAgentStates(Agents, MPC=MPC)
+
+def calcSimStats(Agents, mode='all', print_stats=False):
+    '''
+    Return the estimation statistics for the given AgentTypes, from SimStatsCache
+    if they have been calculated before, otherwise by solving and simulating the
+    economy. 
+
+    Parameters
+    ----------
+    Agents : [AgentType]
+        List of AgentTypes in the economy, with updated discount factors.
+    mode : str, optional
+        Which statistics are needed, see calcEstimStats. The Lorenz points by 
+        education type are only calculated for 'avg' and 'all'. The default is 'all'.
+    print_stats : boolean, optional
+        If true, the economy is always simulated, as the MPC and wealth share 
+        statistics for printing need the gathered states. The default is False.
+
+    Returns
+    -------
+    Stats : namedtuple
+        See calcEstimStats.
+    EdLorenzPts : [np.array(float)] or None
+        Lorenz points for each education type, see calcLorenzPts.
+    States : namedtuple or None
+        Gathered states including MPCs if print_stats is true, otherwise None.
+    '''
+    CacheKey = (mode,) + simStatsKey(Agents)
+    if not print_stats and CacheKey in SimStatsCache:
+        SimStatsCache.move_to_end(CacheKey)
+        Stats, EdLorenzPts = SimStatsCache[CacheKey]
+        return Stats, EdLorenzPts, None
+    
+    States = solveAndSimulate(Agents, MPC=print_stats)
+    Stats = calcEstimStats(States, mode)
+    if mode != 'lorenz_median':
+        EdLorenzPts = [calcLorenzPts(States.aLvl[EdSlice]) for EdSlice in States.EdSlices]
+    else:
+        EdLorenzPts = None
+    
+    SimStatsCache[CacheKey] = (Stats, EdLorenzPts)
+    if len(SimStatsCache) > SimStatsCacheSize:
+        SimStatsCache.popitem(last=False)
+    if not print_stats:
+        States = None
+    return Stats, EdLorenzPts, States
+# -----------------------------------------------------------------------------
 def betasObjFunc(betas, spreads, GICfactors, target_option=1, print_mode=False, print_file=False, filename='DefaultResultsFile.txt'):
     '''
     Objective function for the estimation of discount factor distributions for the 
@@ -422,8 +898,9 @@ def betasObjFunc(betas, spreads, GICfactors, target_option=1, print_mode=False,
         The distance of the estimation targets between those in the data and those
         produced by the model. 
     '''
-    # # Set seed to ensure distance only changes due to different parameters 
-    # random.seed(1234)
+    # The distance only changes due to different parameters: each type draws its 
+    # shocks from its own np.random.Generator (ThisType.RNG), which initialize_sim()
+    # reseeds from ThisType.seed, so no global seed is needed
 
     beta_d, beta_h, beta_c = betas
     spread_d, spread_h, spread_c = spreads
@@ -435,55 +912,38 @@ def betasObjFunc(betas, spreads, GICfactors, target_option=1, print_mode=False,
     dfs = [dfs_d, dfs_h, dfs_c]
 
     # Check GIC for each type:
+    gicCaps = np.asarray(GICmaxBetas)*np.asarray(GICfactors)
     for e in range(num_types):
-        for thedf in range(DiscFacCount):
-            if dfs[e].atoms[0][thedf] > GICmaxBetas[e]*GICfactors[e]: 
-                dfs[e].atoms[0][thedf] = GICmaxBetas[e]*GICfactors[e]
-            elif dfs[e].atoms[0][thedf] < minBeta:
-                dfs[e].atoms[0][thedf] = minBeta
+        np.clip(dfs[e].atoms[0], minBeta, gicCaps[e], out=dfs[e].atoms[0])
 
-    # Make a new list of types with updated discount factors 
-    TypeListNew = []
+    # Update the discount factors of the existing types in place; everything 
+    # else they carry is re-created by solve(), reset() and make_history() below, 
+    # so there is no need to deepcopy the base types on every evaluation
+    TypeListNew = AggDemandEconomy.agents
     n = 0
     for e in range(num_types):
         for b in range(DiscFacCount):
-            AgentCount = int(np.floor(AgentCountTotal*data_EducShares[e]*dfs[e].pmv[b]))
-            ThisType = deepcopy(BaseTypeList[e])
-            ThisType.AgentCount = AgentCount
+            ThisType = TypeListNew[n]
+            ThisType.AgentCount = EdTypeAgentCounts[e]
             ThisType.DiscFac = dfs[e].atoms[0][b]
             ThisType.seed = n
-            TypeListNew.append(ThisType)
             n += 1
-    base_dict['Agents'] = TypeListNew
-
-    AggDemandEconomy.agents = TypeListNew
-    AggDemandEconomy.solve()
-
-    AggDemandEconomy.reset()
-    for agent in AggDemandEconomy.agents:
-        agent.initialize_sim()
-        agent.AggDemandFac = 1.0
-        agent.RfreeNow = 1.0
-        agent.CaggNow = 1.0
-
-    AggDemandEconomy.make_history()   
-    AggDemandEconomy.save_state()   
 
-    # Simulate each type to get a new steady state solution 
-    # solve: done in AggDemandEconomy.solve(), initializeSim: done in AggDemandEconomy.reset() 
-    # baseline_commands = ['solve()', 'initializeSim()', 'simulate()', 'saveState()']
-    baseline_commands = ['simulate()', 'save_state()']
-    multi_thread_commands_fake(TypeListNew, baseline_commands)
-    
-    Stats = calcEstimStats(TypeListNew)
+    # Solve and simulate, unless these discount factors have been evaluated before;
+    # during the estimation only the targeted statistics are calculated
+    if print_mode or print_file:
+        StatsMode = 'all'
+    elif target_option == 1:
+        StatsMode = 'lorenz_median'
+    else:
+        StatsMode = 'avg'
+    Stats, EdLorenzPts, States = calcSimStats(TypeListNew, mode=StatsMode, print_stats=(print_mode or print_file))
     
     if target_option == 1:
         sumSquares = 10*np.sum((Stats.medianLWPI-data_medianLWPI)**2)
         sumSquares += np.sum((np.array(Stats.LorenzPts) - data_LorenzPtsAll)**2)
     elif target_option == 2:
-        lp_d = calcLorenzPts(TypeListNew[0:DiscFacCount])
-        lp_h = calcLorenzPts(TypeListNew[DiscFacCount:2*DiscFacCount])
-        lp_c = calcLorenzPts(TypeListNew[2*DiscFacCount:3*DiscFacCount])
+        lp_d, lp_h, lp_c = EdLorenzPts
         sumSquares = np.sum((np.array(Stats.avgLWPI)-data_avgLWPI)**2)
         sumSquares += np.sum((np.array(lp_d)-data_LorenzPts[0])**2)
         sumSquares += np.sum((np.array(lp_h)-data_LorenzPts[1])**2)
@@ -492,9 +952,9 @@ def betasObjFunc(betas, spreads, GICfactors, target_option=1, print_mode=False,
     distance = np.sqrt(sumSquares)
 
     if print_mode or print_file:
-        WealthShares = calcWealthShareByEd(TypeListNew)
-        MPCsByEd = calcMPCbyEd(TypeListNew)
-        MPCsByW  = calcMPCbyWealth(TypeListNew)
+        WealthShares = calcWealthShareByEd(States)
+        MPCsByEd = calcMPCbyEd(States)
+        MPCsByW  = calcMPCbyWealth(TypeListNew, States)
 
     # If not estimating, print stats by education level
     if print_mode:
@@ -575,56 +1035,35 @@ def betasObjFuncEduc(beta, spread, GICx, educ_type=2, print_mode=False, print_fi
         The distance of the estimation targets between those in the data and those
         produced by the model. 
     '''
-    # # Set seed to ensure distance only changes due to different parameters 
-    # random.seed(1234)
+    # The distance only changes due to different parameters: each type draws its 
+    # shocks from its own np.random.Generator (ThisType.RNG), which initialize_sim()
+    # reseeds from ThisType.seed, so no global seed is needed
 
     dfs = Uniform(beta-spread, beta+spread).discretize(DiscFacCount)
     
     # Check GIC:
-    for thedf in range(DiscFacCount):
-        if dfs.atoms[0][thedf] > GICmaxBetas[educ_type]*np.exp(GICx)/(1+np.exp(GICx)):
-            dfs.atoms[0][thedf] = GICmaxBetas[educ_type]*(np.exp(GICx)/(1+np.exp(GICx)))
-        elif dfs.atoms[0][thedf] < minBeta:
-            dfs.atoms[0][thedf] = minBeta
-
-    # Make a new list of types with updated discount factors for the given educ type
-    TypeListNewEduc = []
-    n = 0
+    gicCap = GICmaxBetas[educ_type]*expit(GICx)    # logistic, exp(x)/(1+exp(x))
+    np.clip(dfs.atoms[0], minBeta, gicCap, out=dfs.atoms[0])
+
+    # Update the discount factors of the existing types of the given educ type in 
+    # place (see betasObjFunc)
+    TypeListEduc = AggDemandEconomy.agents[educ_type*DiscFacCount:(educ_type+1)*DiscFacCount]
     for b in range(DiscFacCount):
-        AgentCount = int(np.floor(AgentCountTotal*data_EducShares[educ_type]*dfs.pmv[b]))
-        ThisType = deepcopy(BaseTypeList[educ_type])
-        ThisType.AgentCount = AgentCount
+        ThisType = TypeListEduc[b]
+        ThisType.AgentCount = EdTypeAgentCounts[educ_type]
         ThisType.DiscFac = dfs.atoms[0][b]
-        ThisType.seed = n
-        TypeListNewEduc.append(ThisType)
-        n += 1
-    TypeListAll = AggDemandEconomy.agents
-    TypeListAll[educ_type*DiscFacCount:(educ_type+1)*DiscFacCount] = TypeListNewEduc
+        ThisType.seed = b
             
-    base_dict['Agents'] = TypeListAll
-    AggDemandEconomy.agents = TypeListAll
-    AggDemandEconomy.solve()
-
-    AggDemandEconomy.reset()
-    for agent in AggDemandEconomy.agents:
-        agent.initialize_sim()
-        agent.AggDemandFac = 1.0
-        agent.RfreeNow = 1.0
-        agent.CaggNow = 1.0
-
-    AggDemandEconomy.make_history()   
-    AggDemandEconomy.save_state()   
-
-    # Simulate each type to get a new steady state solution 
-    # solve: done in AggDemandEconomy.solve(), initializeSim: done in AggDemandEconomy.reset() 
-    # baseline_commands = ['solve()', 'initializeSim()', 'simulate()', 'saveState()']
-    baseline_commands = ['simulate()', 'save_state()']
-    multi_thread_commands_fake(TypeListAll, baseline_commands)
-    
-    Stats = calcEstimStats(TypeListAll)
+    # Solve and simulate only this educ type (the other types do not affect it), 
+    # unless these discount factors have been evaluated before. Stats are then 
+    # for this educ type only, i.e. at index 0, and their Lorenz points are 
+    # this educ type's. The non-targeted avgLWPI, which is only printed, is 
+    # calculated in every mode, so printing uses the same cache entries as the 
+    # estimation
+    Stats, EdLorenzPts, States = calcSimStats(TypeListEduc, mode='lorenz_median')
     
-    sumSquares = np.sum((Stats.medianLWPI[educ_type]-data_medianLWPI[educ_type])**2)
-    lp = calcLorenzPts(TypeListNewEduc)
+    sumSquares = np.sum((Stats.medianLWPI[0]-data_medianLWPI[educ_type])**2)
+    lp = Stats.LorenzPts
     sumSquares += np.sum((np.array(lp) - data_LorenzPts[educ_type])**2)
 #    sumSquares = np.sum((Stats.avgLWPI[educ_type]-data_avgLWPI[educ_type])**2)
    
@@ -633,7 +1072,7 @@ def betasObjFuncEduc(beta, spread, GICx, educ_type=2, print_mode=False, print_fi
     # If not estimating, print stats by education level
     if print_mode:
         print('Median LW/PI-ratio for group e = ' + mystr(educ_type) + ' is: ' \
-              + mystr(Stats.medianLWPI[educ_type][0]))
+              + mystr(Stats.medianLWPI[0][0]))
         if educ_type == 0:
             print('Lorenz shares - Dropouts:')
         elif educ_type == 1:
@@ -644,13 +1083,13 @@ def betasObjFuncEduc(beta, spread, GICx, educ_type=2, print_mode=False, print_fi
         print('Distance = ' + mystr(distance))
         print('Non-targeted moments:')
         print('Average LW/PI-ratios for group e = ' + mystr(educ_type) + ' is: ' \
-              + mystr(Stats.avgLWPI[educ_type]))
+              + mystr(Stats.avgLWPI[0]))
     
     if print_file:
         with open(filename, 'a') as resFile: 
             resFile.write('Education group = '+mystr(educ_type)+': beta = '+mystr4(beta)+
-                          ', nabla = '+mystr4(spread)+', GICfactor = '+mystr4(np.exp(GICx)/(1+np.exp(GICx)))+'\n')
-            resFile.write('\tMedian LW/PI-ratio = '+mystr(Stats.medianLWPI[educ_type][0])+'\n')
+                          ', nabla = '+mystr4(spread)+', GICfactor = '+mystr4(expit(GICx))+'\n')
+            resFile.write('\tMedian LW/PI-ratio = '+mystr(Stats.medianLWPI[0][0])+'\n')
             resFile.write('\tLorenz Points = ['+str(round(lp[0],4))+', '+str(round(lp[1],4))+', '
                           +str(round(lp[2],4))+', '+str(round(lp[3],4))+']\n')
         
@@ -674,7 +1113,23 @@ df_resFileStr = df_resFileStr + '.txt'
 
 print('Estimation results saved in ' + df_resFileStr)
 
-for edType in [0,1,2]:
+def estimateEducType(edType):
+    '''
+    Estimate the discount factor distribution for one education type with 
+    Nelder-Mead. The objective for one education type only depends on the 
+    discount factors of that type's AgentTypes, so the education types can be 
+    estimated at the same time, each in its own copy of the economy.
+    
+    Parameters
+    ----------
+    edType : int
+        Denotes the education type (either 0, 1 or 2).
+
+    Returns
+    -------
+    opt_params : np.array(float)
+        The estimated beta, spread and GICx.
+    '''
     f_temp = lambda x : betasObjFuncEduc(x[0],x[1],x[2], educ_type=edType)
     if edType == 0:
         initValues = [0.75, 0.3, 6]       # Dropouts
@@ -686,25 +1141,97 @@ for edType in [0,1,2]:
         initValues = [0.90,0.02,6]
 
     opt_params = minimize_nelder_mead(f_temp, initValues, verbose=True)
+    return opt_params
+
+def estimateEducTypeInWorker(edType):
+    '''
+    Run estimateEducType in a worker process and also return the worker's cached
+    statistics for the estimates, so that printing the results for the estimates
+    afterwards does not have to simulate the education type again. Stats is 
+    converted to a dict, as its namedtuple class cannot be pickled.
+    
+    Parameters
+    ----------
+    edType : int
+        Denotes the education type (either 0, 1 or 2).
+
+    Returns
+    -------
+    opt_params : np.array(float)
+        The estimated beta, spread and GICx.
+    CacheItem : (tuple, dict, [np.array(float)] or None)
+        Key, Stats (as a dict) and EdLorenzPts of the SimStatsCache entry for opt_params.
+    '''
+    # The education types are estimated at the same time, so each worker only 
+    # uses its share of the cores for simulating and gathering states. The 
+    # thread pool is also replaced as the forked process has none of its threads
+    global SimJobs, StatsPool
+    SimJobs = max(1, os.cpu_count() // len(EstimEducTypes))
+    StatsPool = ThreadPoolExecutor(max_workers=SimJobs)
+    numba.set_num_threads(min(SimJobs, numba.config.NUMBA_NUM_THREADS))
+    
+    opt_params = estimateEducType(edType)
+    # Evaluating the estimates again (usually a cache hit) makes their entry the 
+    # most recently used one in SimStatsCache
+    betasObjFuncEduc(opt_params[0], opt_params[1], opt_params[2], educ_type=edType)
+    CacheKey, (Stats, EdLorenzPts) = next(reversed(SimStatsCache.items()))
+    # Stop this worker's joblib processes, which would otherwise keep it from exiting
+    get_reusable_executor().shutdown(wait=True)
+    return opt_params, (CacheKey, Stats._asdict(), EdLorenzPts)
+
+EstimEducTypes = [0,1,2]
+if sys.platform.startswith('linux'):
+    # Forked workers get a copy of the economy as set up above (a spawned worker
+    # would re-run this whole script). The copy is copy-on-write, so the solution
+    # grids of the other education types, which a worker never re-solves, stay 
+    # shared with this process rather than being duplicated in each worker. 
+    # Forking is only safe on Linux: on macOS, system libraries used by the 
+    # parent's threads can crash a forked child
+    
+    # The workers start their own joblib processes for simulating; the ones of 
+    # this process are stopped, as a forked copy of them would hang
+    get_reusable_executor().shutdown(wait=True)
+    with ProcessPoolExecutor(max_workers=len(EstimEducTypes), 
+                             mp_context=multiprocessing.get_context('fork')) as EstimPool:
+        WorkerResults = list(EstimPool.map(estimateEducTypeInWorker, EstimEducTypes))
+    opt_params_all = [opt_params for opt_params, CacheItem in WorkerResults]
+    # The entries are added as the most recently used ones, so trimming the cache
+    # only drops older entries
+    for opt_params, (CacheKey, StatsDict, EdLorenzPts) in WorkerResults:
+        Stats = namedtuple("Stats", StatsDict.keys())(**StatsDict)
+        SimStatsCache[CacheKey] = (Stats, EdLorenzPts)
+        SimStatsCache.move_to_end(CacheKey)
+    while len(SimStatsCache) > SimStatsCacheSize:
+        SimStatsCache.popitem(last=False)
+else:
+    opt_params_all = [estimateEducType(edType) for edType in EstimEducTypes]
+
+outLines = []
+for edType, opt_params in zip(EstimEducTypes, opt_params_all):
     print('Finished estimating for education type = '+str(edType)+'. Optimal beta, spread and GIC factor are:')
     print('Beta = ' + mystr4(opt_params[0]) +'  Nabla = ' + mystr4(opt_params[1]) + 
-          ' GIC factor = ' + mystr4(np.exp(opt_params[2])/(1+np.exp(opt_params[2]))))
-
-    if edType == 0:
-        mode = 'a'      # Overwrite old file...
-    else:
-        mode = 'a'      # ...but append all results in same file 
-    with open(df_resFileStr, mode) as f: 
-        outStr = repr({'EducationGroup' : edType, 'beta' : opt_params[0], 'nabla' : opt_params[1], 'GICx' : opt_params[2]})
-        f.write(outStr+'\n')
-        f.close()
-        
+          ' GIC factor = ' + mystr4(expit(opt_params[2])))
+    outLines.append(json.dumps({'EducationGroup' : edType, 'beta' : float(opt_params[0]), 'nabla' : float(opt_params[1]), 
+                                'GICx' : float(opt_params[2])}))
+outLines.append('\nParameters: R = '+str(round(Rfree_base[0],2))+', CRRA = '+str(round(CRRA,2))
+                +', IncUnemp = '+str(round(IncUnemp,2))+', IncUnempNoBenefits = '+str(round(IncUnempNoBenefits,2))
+                +', Splurge = '+str(Splurge))
+
+# Append all results to the file at once 
 with open(df_resFileStr, 'a') as f: 
-    f.write('\nParameters: R = '+str(round(Rfree_base[0],2))+', CRRA = '+str(round(CRRA,2))
-          +', IncUnemp = '+str(round(IncUnemp,2))+', IncUnempNoBenefits = '+str(round(IncUnempNoBenefits,2))
-          +', Splurge = '+str(Splurge) +'\n')
+    f.write('\n'.join(outLines)+'\n')
 
 #%% Read in estimates and calculate all results:
+def loadEstimLine(readStr):
+    '''
+    Parse one line of estimates from a DiscFacEstim results file. The lines are 
+    written as JSON; files written by earlier versions contain the dict's repr.
+    '''
+    try:
+        return json.loads(readStr)
+    except json.JSONDecodeError:
+        return ast.literal_eval(readStr)
+
 if IncUnemp == 0.7 and IncUnempNoBenefits == 0.5:
     # Baseline unemployment system: 
     print('Calculating all results for CRRA = '+str(round(CRRA,1))+' and R = ' + str(round(Rfree_base[0],3))+':\n')
@@ -734,12 +1261,12 @@ myEstim = [[],[],[]]
 betFile = open(df_resFileStr, 'r')
 readStr = betFile.readline().strip()
 while readStr != '' :
-    dictload = eval(readStr)
+    dictload = loadEstimLine(readStr)
     edType = dictload['EducationGroup']
     beta = dictload['beta']
     nabla = dictload['nabla']
     GICx = dictload['GICx']
-    GICfactor = np.exp(GICx)/(1+np.exp(GICx))
+    GICfactor = expit(GICx)
     myEstim[edType] = [beta,nabla,GICx, GICfactor]
     betasObjFuncEduc(beta, nabla, GICx, educ_type = edType, print_mode=True, print_file=True, filename=ar_resFileStr)
     checkDiscFacDistribution(beta, nabla, GICfactor, edType, print_mode=True, print_file=True, filename=ar_resFileStr)
@@ -763,7 +1290,7 @@ if run_additional_analysis:
 
     ar_resFileStr = res_dir + 'DEBUG_checkDiscFacDistribution.txt'
     GICx = 6.0832796965018225
-    GICfactor = np.exp(GICx)/(1+np.exp(GICx))
+    GICfactor = expit(GICx)
     checkDiscFacDistribution(0.7354184459881328, 0.29783637632458415, GICfactor, edType, print_mode=True, print_file=True, filename=ar_resFileStr)
 
 # d - (0.72, 0.5)        
@@ -782,12 +1309,12 @@ if run_additional_analysis:
         betFile = open(res_dir+'/DiscFacEstim_CRRA_'+str(CRRA)+'_R_'+str(Rfree_base[0])+'_altBenefits.txt', 'r')
     readStr = betFile.readline().strip()
     while readStr != '' :
-        dictload = eval(readStr)
+        dictload = loadEstimLine(readStr)
         edType = dictload['EducationGroup']
         beta = dictload['beta']
         nabla = dictload['nabla']
         GICx = dictload['GICx']
-        GICfactor = np.exp(GICx)/(1+np.exp(GICx))
+        GICfactor = expit(GICx)
         myEstim[edType] = [beta,nabla,GICx,GICfactor]
         readStr = betFile.readline().strip()
     betFile.close()
@@ -816,7 +1343,7 @@ if run_additional_analysis:
 
 #%% Plot of MPCs
 if run_additional_analysis:
-    mpcs = calcMPCbyEd(AggDemandEconomy.agents)
+    mpcs = calcMPCbyEd(gatherAgentStates(AggDemandEconomy.agents, MPC=True))
     
     plt.plot(range(len(mpcs[0])), np.sort(mpcs[0]))
     plt.xlabel('Agents')
@@ -1,13 +1,15 @@
 # Import python tools
 import os
+import inspect
 import numpy as np
-import random
 from copy import deepcopy
+from collections import OrderedDict
 import pandas as pd
+import joblib
 
 # Import needed tools from HARK
 from HARK.distribution import Uniform
-from HARK.utilities import get_percentiles, get_lorenz_shares, make_figs
+from HARK.utilities import get_lorenz_shares, make_figs
 from HARK.parallel import multi_thread_commands
 from scipy.optimize import minimize
 from HARK.ConsumptionSaving.ConsIndShockModel import KinkedRconsumerType
@@ -87,6 +89,46 @@ RandomLotteryWin = True #if True, then the 5th element will be replaced with a r
 lorenz_target = np.array([0.029, 0.354, 1.84, 7.42])/100
 KY_target = 6.60
 
+# Solutions of the consumer types by (DiscFac, CRRA), kept for the most recently 
+# used discount factors so that objective evaluations revisiting a discount 
+# factor (the optimizer's steps often move only part of the distribution) skip
+# solving that consumer type again
+SolutionCache = OrderedDict()
+SolutionCacheSize = 256
+
+# Work arrays of the quarterly lottery simulation, kept across objective evaluations
+LotteryBuffers = dict()
+
+def get_lottery_buffer(name, type_num, shape):
+    '''
+    Returns the work array called name for consumer type type_num, allocating
+    it (filled with zeros) only the first time it is requested with this shape. 
+    The contents are left over from the previous objective evaluation.
+    '''
+    key = (name, type_num)
+    if key not in LotteryBuffers or LotteryBuffers[key].shape != shape:
+        LotteryBuffers[key] = np.zeros(shape)
+    return LotteryBuffers[key]
+
+# Lottery draws of each consumer type, drawn once for all objective evaluations
+LotteryDraws = dict()
+
+def get_lottery_draws(type_num, AgentCount, N_Quarter_Sim):
+    '''
+    Returns the lottery draws of consumer type type_num: an AgentCount x 
+    N_Quarter_Sim array with a single 1 in each row indicating the quarter of 
+    the agent's lottery win, and a random lottery size (one of the four bins) 
+    for each agent. The draws are seeded by type and made only once, so every 
+    objective evaluation uses the same draws (common random numbers), just as 
+    reset_rng() gives every evaluation the same income shocks.
+    '''
+    if type_num not in LotteryDraws or LotteryDraws[type_num][0].shape != (AgentCount,N_Quarter_Sim):
+        LotteryRNG = np.random.default_rng([55, type_num])
+        LotteryWin = np.zeros((AgentCount,N_Quarter_Sim))
+        LotteryWin[np.arange(AgentCount),LotteryRNG.integers(0,4,size=AgentCount)] = 1
+        LotterySizeRandom = lottery_size[LotteryRNG.integers(0,4,size=AgentCount)]
+        LotteryDraws[type_num] = (LotteryWin, LotterySizeRandom)
+    return LotteryDraws[type_num]
 
 
 
@@ -117,7 +159,6 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
     # Give our consumer types the requested discount factor distribution
     for j in range(TypeCount):
         EstTypeList[j].reset_rng()
-    random.seed(55)
     beta_set = Uniform(bot=center-spread, top=center+spread).discretize(TypeCount).atoms[0]
     
     # Taper off toward the growth impatience condition 
@@ -135,20 +176,34 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
     for j in range(TypeCount):
         EstTypeList[j].DiscFac = beta_set[j]
 
-    # Solve and simulate all consumer types, then gather their wealth levels
-    multi_thread_commands(EstTypeList,['solve()','initialize_sim()','simulate()', 'unpack_cFunc()'])
+    # Solve the consumer types whose discount factor has not been solved before
+    SolveIdx = []
+    for j in range(TypeCount):
+        SolutionKey = (round(EstTypeList[j].DiscFac, 10), EstTypeList[j].CRRA)
+        if SolutionKey in SolutionCache:
+            SolutionCache.move_to_end(SolutionKey)
+            EstTypeList[j].solution = SolutionCache[SolutionKey]
+        else:
+            SolveIdx.append(j)
+    if len(SolveIdx) > 0:
+        SolveList = [EstTypeList[j] for j in SolveIdx]
+        multi_thread_commands(SolveList,['solve()'])
+        for j, ThisType in zip(SolveIdx, SolveList):
+            EstTypeList[j] = ThisType # multi_thread_commands returns solved copies
+            SolutionCache[(round(ThisType.DiscFac, 10), ThisType.CRRA)] = ThisType.solution
+        while len(SolutionCache) > SolutionCacheSize:
+            SolutionCache.popitem(last=False)
+    
+    # Simulate all consumer types, then gather their wealth levels
+    multi_thread_commands(EstTypeList,['initialize_sim()','simulate()', 'unpack_cFunc()'])
     WealthNow = np.concatenate([ThisType.state_now["aLvl"] for ThisType in EstTypeList])
     
 
-    # Get wealth quartile cutoffs and distribute them to each consumer type
-    quartile_cuts = get_percentiles(WealthNow,percentiles=[0.25,0.50,0.75])
-    wealth_list = np.array([])
+    # Get wealth quartile cutoffs and distribute them to each consumer type; the
+    # interpolated inverted CDF is the same inverse CDF as HARK's get_percentiles
+    quartile_cuts = np.quantile(WealthNow,[0.25,0.50,0.75],method='interpolated_inverted_cdf')
     for ThisType in EstTypeList:
-        WealthQ = np.zeros(ThisType.AgentCount,dtype=int)
-        for n in range(3):
-            WealthQ[ThisType.state_now["aLvl"] > quartile_cuts[n]] += 1
-        ThisType.WealthQ = WealthQ
-        wealth_list = np.concatenate((wealth_list, ThisType.state_now["aLvl"] ))
+        ThisType.WealthQ = np.searchsorted(quartile_cuts,ThisType.state_now["aLvl"]) # number of cutoffs below aLvl
             
 
          
@@ -176,30 +231,29 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
         N_Year_Sim = int(N_Quarter_Sim/4)
         N_Lottery_Win_Sizes = 5 # 4 lottery size bin + 1 representative one for agg MPCX
     
+        MPC_this_type = get_lottery_buffer('MPC_this_type', None, (TypeCount, ThisType.AgentCount,N_Lottery_Win_Sizes,N_Year_Sim)) #MPC for each Lottery size and agent, only k below is overwritten
         
-        EmptyList = [[],[],[],[],[]]
-        MPC_set_list = [deepcopy(EmptyList),deepcopy(EmptyList),deepcopy(EmptyList),deepcopy(EmptyList)]
-        MPC_Lists    = [deepcopy(MPC_set_list),deepcopy(MPC_set_list),deepcopy(MPC_set_list),deepcopy(MPC_set_list),deepcopy(MPC_set_list)]    
-        # additional list for 5th Lottery bin, just need for elements for four years
-        MPC_List_Add_Lottery_Bin = EmptyList
+        #for k in range(N_Lottery_Win_Sizes): # Loop through different lottery sizes, only this will produce values in simulated_MPC_means
+        k = 4; # do not loop to save time, so the arrays below only hold the representative lottery size
         
-        MPC_this_type = np.zeros((TypeCount, ThisType.AgentCount,N_Lottery_Win_Sizes,N_Year_Sim)) #Empty array, MPC for each Lottery size and agent
+        # Look up the constants of the quarter loop once
+        Rboro = base_params['Rboro']
+        Rsave = base_params['Rsave']
+        aNrmInit = np.exp(base_params['aNrmInitMean'])
             
         for type_num, ThisType in zip(range(TypeCount), EstTypeList):
             
-            c_base = np.zeros((ThisType.AgentCount,N_Quarter_Sim))                        #c_base (in case of no lottery win) for each quarter
-            c_base_Lvl = np.zeros((ThisType.AgentCount,N_Quarter_Sim))                    #same in levels
-            c_actu = np.zeros((ThisType.AgentCount,N_Quarter_Sim,N_Lottery_Win_Sizes))    #c_actu (actual consumption in case of lottery win in one random quarter) for each quarter and lottery size
-            c_actu_Lvl = np.zeros((ThisType.AgentCount,N_Quarter_Sim,N_Lottery_Win_Sizes))#same in levels
-            a_actu = np.zeros((ThisType.AgentCount,N_Quarter_Sim,N_Lottery_Win_Sizes))    #a_actu captures the actual market resources after potential lottery win (last index) was added and c_actu deducted
-            T_hist = np.zeros((ThisType.AgentCount,N_Quarter_Sim))
-            P_hist = np.zeros((ThisType.AgentCount,N_Quarter_Sim)) 
+            # Every quarter of these is overwritten below
+            QuarterShape = (ThisType.AgentCount,N_Quarter_Sim)
+            c_base = get_lottery_buffer('c_base', type_num, QuarterShape)              #c_base (in case of no lottery win) for each quarter
+            c_base_Lvl = get_lottery_buffer('c_base_Lvl', type_num, QuarterShape)      #same in levels
+            c_actu = get_lottery_buffer('c_actu', type_num, QuarterShape)              #c_actu (actual consumption in case of lottery win in one random quarter) for each quarter
+            c_actu_Lvl = get_lottery_buffer('c_actu_Lvl', type_num, QuarterShape)      #same in levels
+            a_actu = get_lottery_buffer('a_actu', type_num, QuarterShape)              #a_actu captures the actual market resources after potential lottery win was added and c_actu deducted
                 
             # LotteryWin is an array with AgentCount x 4 periods many entries; there is only one 1 in each row indicating the quarter of the Lottery win for the agent in each row
-            # This can be coded more efficiently
-            LotteryWin = np.zeros((ThisType.AgentCount,N_Quarter_Sim))   
-            for i in range(ThisType.AgentCount):
-                LotteryWin[i,random.randint(0,3)] = 1
+            LotteryWin, LotterySizeRandom = get_lottery_draws(type_num, ThisType.AgentCount, N_Quarter_Sim)
+            cFunc = ThisType.cFunc[0]
                 
 
             for period in range(N_Quarter_Sim): #Simulate for 4 quarters as opposed to 1 year
@@ -207,74 +261,49 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
                 # Simulate forward for one quarter
                 ThisType.simulate(1)           
                 
+                pLvl = ThisType.state_now["pLvl"]
+                TranShk = ThisType.shocks["TranShk"]
+                
                 # capture base consumption which is consumption in absence of lottery win
                 c_base[:,period] = ThisType.controls["cNrm"] 
-                c_base_Lvl[:,period] = c_base[:,period] * ThisType.state_now["pLvl"]
+                c_base_Lvl[:,period] = c_base[:,period] * pLvl
                 
-            
-                #for k in range(N_Lottery_Win_Sizes): # Loop through different lottery sizes, only this will produce values in simulated_MPC_means
-                k = 4; # do not loop to save time 
                 
                 Llvl = lottery_size[k]*LotteryWin[:,period]  #Lottery win occurs only if LotteryWin = 1 for that agent
                 
                 if RandomLotteryWin and k == 5:
-                    for i in range(ThisType.AgentCount):
-                        Llvl[i] = lottery_size[random.randint(0,3)]*LotteryWin[i,period]
-                        if LotteryWin[i,period]==1 and i==0:
-                            print(Llvl[i])
+                    Llvl = LotterySizeRandom*LotteryWin[:,period]
+                    if LotteryWin[0,period]==1:
+                        print(Llvl[0])
                 
-                Lnrm = Llvl/ThisType.state_now["pLvl"]
+                Lnrm = Llvl/pLvl
                 SplurgeNrm = SplurgeEstimate*Lnrm  #Splurge occurs only if LotteryWin = 1 for that agent
         
             
-                R_kink = np.zeros((ThisType.AgentCount))       
-                for i in range(ThisType.AgentCount):
-                    if a_actu[i,period-1,k] < 0:
-                        R_kink[i] = base_params['Rboro']
-                    else:
-                        R_kink[i] = base_params['Rsave']  
-                
-                
                 if period == 0:
-                    m_adj = ThisType.state_now["mNrm"]  + Lnrm - SplurgeNrm
-                    c_actu[:,period,k] = ThisType.cFunc[0](m_adj) + SplurgeNrm
-                    c_actu_Lvl[:,period,k] = c_actu[:,period,k] * ThisType.state_now["pLvl"]
-                    a_actu[:,period,k] = ThisType.state_now["mNrm"] + Lnrm - c_actu[:,period,k] #save for next periods
+                    m_actu = ThisType.state_now["mNrm"] + Lnrm
                 else:  
-                    T_hist[:,period] = ThisType.shocks["TranShk"] 
-                    P_hist[:,period] = ThisType.shocks["PermShk"]
-                    for i_agent in range(ThisType.AgentCount):
-                        if ThisType.shocks["TranShk"][i_agent] == 1.0: # indicator of death
-                            a_actu[i_agent,period-1,k] = np.exp(base_params['aNrmInitMean'])
-                    m_adj = a_actu[:,period-1,k]*R_kink/ThisType.shocks["PermShk"] + ThisType.shocks["TranShk"] + Lnrm - SplurgeNrm #continue with resources from last period
-                    c_actu[:,period,k] = ThisType.cFunc[0](m_adj) + SplurgeNrm
-                    c_actu_Lvl[:,period,k] = c_actu[:,period,k] * ThisType.state_now["pLvl"]
-                    a_actu[:,period,k] = a_actu[:,period-1,k]*R_kink/ThisType.shocks["PermShk"] + ThisType.shocks["TranShk"] + Lnrm - c_actu[:,period,k] 
+                    R_kink = np.where(a_actu[:,period-1] < 0, Rboro, Rsave)
+                    # TranShk == 1.0 is the indicator of death
+                    a_actu[:,period-1] = np.where(TranShk == 1.0, aNrmInit, a_actu[:,period-1])
+                    m_actu = a_actu[:,period-1]*R_kink/ThisType.shocks["PermShk"] + TranShk + Lnrm #continue with resources from last period
+                m_adj = m_actu - SplurgeNrm
+                c_actu[:,period] = cFunc(m_adj) + SplurgeNrm
+                c_actu_Lvl[:,period] = c_actu[:,period] * pLvl
+                a_actu[:,period] = m_actu - c_actu[:,period] #save for next periods
                     
-                if period%4 + 1 == 4: #if we are in the 4th quarter of a year
-                    year = int((period+1)/4)
-                    c_actu_Lvl_year = c_actu_Lvl[:,(year-1)*4:year*4,k]
-                    c_base_Lvl_year = c_base_Lvl[:,(year-1)*4:year*4]
-                    MPC_this_type[type_num,:,k,year-1] = (np.sum(c_actu_Lvl_year,axis=1) - np.sum(c_base_Lvl_year,axis=1))/(lottery_size[k])
+            # Sum consumption over the four quarters of each year to get the annual MPCs
+            c_actu_Lvl_year = c_actu_Lvl.reshape((ThisType.AgentCount,N_Year_Sim,4)).sum(axis=2)
+            c_base_Lvl_year = c_base_Lvl.reshape((ThisType.AgentCount,N_Year_Sim,4)).sum(axis=2)
+            MPC_this_type[type_num,:,k,:] = (c_actu_Lvl_year - c_base_Lvl_year)/(lottery_size[k])
                         
-            
-            # Sort the MPCs into the proper MPC sets
-            for q in range(4):
-                these = ThisType.WealthQ == q
-                for k in range(N_Lottery_Win_Sizes):
-                    for y in range(N_Year_Sim):
-                        MPC_Lists[k][q][y].append(MPC_this_type[type_num,these,k,y])
-                        
-            # sort MPCs for addtional Lottery bin
-            for y in range(N_Year_Sim):
-                MPC_List_Add_Lottery_Bin[y].append(MPC_this_type[type_num,:,4,y])
-
+        # MPCs and wealth quartiles of all agents, in the same order as WealthNow
+        MPC_all = MPC_this_type.reshape((-1,N_Lottery_Win_Sizes,N_Year_Sim))
+        WealthQ_all = np.concatenate([ThisType.WealthQ for ThisType in EstTypeList])
                 
         #Create a list of wealth and MPCs
-        MPC_list = np.array([])
-        for type_num, ThisType in zip(range(TypeCount), EstTypeList):
-            MPC_list = np.concatenate((MPC_list, MPC_this_type[type_num, :, 4, 0] ))
-        sorted_wealth_MPC = np.stack((wealth_list, MPC_list))[:,wealth_list.argsort()]
+        MPC_list = MPC_all[:,4,0]
+        sorted_wealth_MPC = np.stack((WealthNow, MPC_list))[:,WealthNow.argsort()]
         total_agents = len(MPC_list)
         quartile1_weights = np.zeros(total_agents)
         quartile1_weights[0:int(np.floor(total_agents*9/40))] = 1.0
@@ -293,19 +322,13 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
         simulated_MPC_means_smoothed[3] = np.average(sorted_wealth_MPC[1],weights=quartile4_weights)
         
         #if estimation_mode==False or target == 'AGG_MPC_plus_Liqu_Wealth_plusKY_plusMPC':     
-        # Calculate average within each MPC set
+        # Calculate average within each MPC set (lottery size, wealth quartile and year)
         simulated_MPC_means = np.zeros((N_Lottery_Win_Sizes,4,N_Year_Sim))
-        for k in range(N_Lottery_Win_Sizes):
-            for q in range(4):
-                for y in range(N_Year_Sim):
-                    MPC_array = np.concatenate(MPC_Lists[k][q][y])
-                    simulated_MPC_means[k,q,y] = np.mean(MPC_array)
+        for q in range(4):
+            simulated_MPC_means[:,q,:] = np.mean(MPC_all[WealthQ_all == q],axis=0)
                     
         # Calculate aggregate MPC and MPCx
-        simulated_MPC_mean_add_Lottery_Bin = np.zeros((N_Year_Sim))
-        for y in range(N_Year_Sim):
-            MPC_array = np.concatenate(MPC_List_Add_Lottery_Bin[y])
-            simulated_MPC_mean_add_Lottery_Bin[y] = np.mean(MPC_array)
+        simulated_MPC_mean_add_Lottery_Bin = np.mean(MPC_all[:,4,:],axis=0)
                 
         # Calculate Euclidean distance between simulated MPC averages and Table 9 targets
         
@@ -394,8 +417,8 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
         Output['distance_KY'] = distance_KY
         Output['simulated_MPC_means_smoothed'] = simulated_MPC_means_smoothed
         Output['simulated_MPC_mean_add_Lottery_Bin'] = simulated_MPC_mean_add_Lottery_Bin
-        Output['c_actu_Lvl'] = c_actu_Lvl
-        Output['c_base_Lvl'] = c_base_Lvl
+        Output['c_actu_Lvl'] = np.copy(c_actu_Lvl) # the arrays are reused by the next call
+        Output['c_base_Lvl'] = np.copy(c_base_Lvl)
         Output['LotteryWin'] = LotteryWin
         Output['Lorenz_Data'] = Lorenz_Data
         Output['Lorenz_Data_Adj'] = Lorenz_Data_Adj
@@ -403,6 +426,32 @@ def FagerengObjFunc(SplurgeEstimate,center,spread,verbose=False,estimation_mode=
         return Output
 
 
+# Objective values are stored on disk, so that a rerun of the estimation, or a 
+# later start point passing through the same parameters, reads them back instead 
+# of solving and simulating again. The stored values are keyed by the arguments
+# and by a hash of the objective function's code, the parameters and the targets,
+# so changing any of these does not read back stale values.
+ObjFuncMemory = joblib.Memory(location=Abs_Path+'/ObjFuncCache', verbose=0)
+ObjFuncSource = ''.join(inspect.getsource(func) for func in 
+                        [FagerengObjFunc, get_lottery_buffer, get_lottery_draws])
+
+@ObjFuncMemory.cache
+def FagerengObjFuncStored(SplurgeEstimate,center,spread,target,ModelHash):
+    '''
+    FagerengObjFunc in estimation mode, with its value stored on disk. ModelHash 
+    is only passed to tell apart the models and targets it was evaluated for.
+    '''
+    return FagerengObjFunc(SplurgeEstimate,center,spread,target=target)
+
+def stored_obj_func(SplurgeEstimate,center,spread,target):
+    # Hashed on every call, as base_params changes between the robustness runs
+    ModelHash = joblib.hash((ObjFuncSource, Parametrization, base_params, TypeCount, 
+                             AdjFactor, drop_corner, MPC_target, Agg_MPCX_target, 
+                             lottery_size, RandomLotteryWin, lorenz_target, KY_target))
+    # Pass plain floats so that numpy scalars and floats share the stored values
+    return FagerengObjFuncStored(float(SplurgeEstimate),float(center),float(spread),target,ModelHash)
+
+
 def save_betanabla_res_txt(filename,res):
     with open(Abs_Path+filename, 'w') as f:
         str1 = repr(res)
@@ -420,13 +469,17 @@ def load_betanabla_res_txt(filename):
     return [splurge,beta,nabla]
 
 
+# Options of the (bounded) Nelder-Mead searches below; the adaptive simplex 
+# parameters suit the 2 and 3 parameter searches, and the tolerances stop once 
+# the parameters are pinned down to the precision used to check the minimum
+NelderMeadOptions = {'adaptive': True, 'xatol': 1e-4, 'fatol': 1e-6}
+
 def find_Opt(target='', startpoint = [0.27,0.96,0.03], check_maximum = False):
     
     bounds = [(0.0,0.9),(0.7,1.1),(0.0,0.4)]
         
-    f_temp = lambda x : FagerengObjFunc(x[0],x[1],x[2],target=target)
-    #opt = minimizeNelderMead(f_temp, startpoint2, verbose=1, xtol=0.001, ftol=0.001)
-    opt_output = minimize(f_temp, startpoint,method="Powell", bounds =bounds)
+    f_temp = lambda x : stored_obj_func(x[0],x[1],x[2],target=target)
+    opt_output = minimize(f_temp, startpoint,method="Nelder-Mead", bounds =bounds, options=NelderMeadOptions)
     opt = opt_output.x
     obs = opt_output.fun
     beta = opt[1]
@@ -439,7 +492,7 @@ def find_Opt(target='', startpoint = [0.27,0.96,0.03], check_maximum = False):
         check_start = [opt[0],opt[2]]
         check_obs = [0.0, 0.0]
         for i,deviation in zip(range(2), [-0.0001, 0.0001]):
-            f_temp = lambda y : FagerengObjFunc(y[0],opt[1]+deviation,y[1],target=target)
+            f_temp = lambda y : stored_obj_func(y[0],opt[1]+deviation,y[1],target=target)
             check_opt = minimize(f_temp, check_start,method="Powell", bounds = [(0.0,0.9),(0.0,0.4)])
             check_obs[i] = check_opt.fun
         print("Objective around minimum:")
@@ -455,8 +508,8 @@ def find_Opt(target='', startpoint = [0.27,0.96,0.03], check_maximum = False):
 def find_Opt_splurge0(target='', startpoint = [0.96,0.03], check_maximum = False):
         
 
-    f_temp = lambda x : FagerengObjFunc(0,x[0],x[1], target=target)
-    opt_output = minimize(f_temp, startpoint,method="Powell", bounds = [(0.7,1.01),(0.0,0.4)])
+    f_temp = lambda x : stored_obj_func(0,x[0],x[1], target=target)
+    opt_output = minimize(f_temp, startpoint,method="Nelder-Mead", bounds = [(0.7,1.01),(0.0,0.4)], options=NelderMeadOptions)
     opt = opt_output.x
     obs = opt_output.fun
     beta = opt[0]
@@ -467,7 +520,7 @@ def find_Opt_splurge0(target='', startpoint = [0.96,0.03], check_maximum = False
         check_start = [opt[1]]
         check_obs = [0.0, 0.0]
         for i,deviation in zip(range(2), [-0.0001, 0.0001]):
-            f_temp = lambda y : FagerengObjFunc(0,opt[0]+deviation,y[0],target=target)
+            f_temp = lambda y : stored_obj_func(0,opt[0]+deviation,y[0],target=target)
             check_opt = minimize(f_temp, check_start,method="L-BFGS-B", bounds = [(0.0,0.4)])
             check_obs[i] = check_opt.fun
             print([opt[0]+deviation,check_opt.x,check_opt.fun])
@@ -483,11 +536,7 @@ def find_Opt_splurge0(target='', startpoint = [0.96,0.03], check_maximum = False
 
 
 # Make several consumer types to be used during estimation
-BaseType = KinkedRconsumerType(**base_params)
-EstTypeList = []
-for j in range(TypeCount):
-    EstTypeList.append(deepcopy(BaseType))
-    EstTypeList[-1].seed = j
+EstTypeList = [KinkedRconsumerType(**base_params, seed=j) for j in range(TypeCount)]
 
 
 
@@ -674,11 +723,7 @@ if Run_other_CRRA_values:
     
         # Make several consumer types to be used during estimation
         del EstTypeList
-        BaseTypeCRRA = KinkedRconsumerType(**base_params)
-        EstTypeList = []
-        for j in range(TypeCount):
-            EstTypeList.append(deepcopy(BaseTypeCRRA))
-            EstTypeList[-1].seed = j
+        EstTypeList = [KinkedRconsumerType(**base_params, seed=j) for j in range(TypeCount)]
     
     
     
@@ -709,22 +754,14 @@ if Plot_other_CRRA_values:
     # CRRA=1 
     del EstTypeList
     base_params['CRRA'] = 1
-    BaseType = KinkedRconsumerType(**base_params)
-    EstTypeList = []
-    for j in range(TypeCount):
-        EstTypeList.append(deepcopy(BaseType))
-        EstTypeList[-1].seed = j
+    EstTypeList = [KinkedRconsumerType(**base_params, seed=j) for j in range(TypeCount)]
     [splurge,beta,nabla] = load_betanabla_res_txt('\Result_AllTarget_CRRA_1.txt')
     CRRA1=FagerengObjFunc(splurge,beta,nabla,estimation_mode=False,target=target)
     
     # CRRA=2
     del EstTypeList
     base_params['CRRA'] = 3
-    BaseType = KinkedRconsumerType(**base_params)
-    EstTypeList = []
-    for j in range(TypeCount):
-        EstTypeList.append(deepcopy(BaseType))
-        EstTypeList[-1].seed = j
+    EstTypeList = [KinkedRconsumerType(**base_params, seed=j) for j in range(TypeCount)]
     [splurge,beta,nabla] = load_betanabla_res_txt('\Result_AllTarget_CRRA_3.txt')
     CRRA3=FagerengObjFunc(splurge,beta,nabla,estimation_mode=False,target=target)
     